@@ -7,7 +7,7 @@ from src.methods.dummy_methods import DummyClassifier
 from src.methods.logistic_regression import LogisticRegression
 from src.methods.linear_regression import LinearRegression 
 from src.methods.knn import KNN
-from src.utils import normalize_fn, append_bias_term, accuracy_fn, macrof1_fn, mse_fn, compute_mean, compute_std, create_validation_set,run_cv_for_hyperparam,plot_k_vs_accuracy_cv
+from src.utils import normalize_and_bias, accuracy_fn, macrof1_fn, mse_fn, compute_mean, compute_std, create_validation_set,run_cv_for_hyperparam,plot_k_vs_accuracy_cv
 import os
 np.random.seed(100)
 
@@ -31,6 +31,13 @@ def main(args):
         data_dir = os.path.join(args.data_path,'dog-small-64')
         xtrain, xtest, ytrain, ytest, ctrain, ctest = load_data(data_dir)
 
+    # Single precision is enough for the features and regression targets, and
+    # halves the memory traffic of the preprocessing and distance computations
+    xtrain = xtrain.astype(np.float32, copy=False)
+    xtest = xtest.astype(np.float32, copy=False)
+    ctrain = ctrain.astype(np.float32, copy=False)
+    ctest = ctest.astype(np.float32, copy=False)
+
     ##TODO: ctrain and ctest are for regression task. (To be used for Linear Regression and KNN)  
     ##TODO: xtrain, xtest, ytrain, ytest are for classification task. (To be used for Logistic Regression and KNN)
 
@@ -49,11 +56,11 @@ def main(args):
     ## For xtrain, xtest
     mean_val_x = compute_mean(xtrain)
     std_val_x = compute_std(xtrain)
+    # Constant features are left unscaled instead of becoming NaN
+    inv_std_x = 1.0 / np.where(std_val_x==0, 1.0, std_val_x)
 
-    xtrain = normalize_fn(xtrain,mean_val_x,std_val_x)
-    xtrain = append_bias_term(xtrain)
-    xtest = normalize_fn(xtest,mean_val_x,std_val_x)
-    xtest = append_bias_term(xtest)
+    xtrain = normalize_and_bias(xtrain,mean_val_x,inv_std_x)
+    xtest = normalize_and_bias(xtest,mean_val_x,inv_std_x)
    
 
     ## 3. Initialize the method you want to use.
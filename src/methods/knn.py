@@ -1,120 +1,58 @@
 import numpy as np
+from numba import njit, prange
 
+# Number of test examples whose distances are computed at once in KNN.predict:
+# large enough for the matrix product to amortize reading the training data,
+# small enough to bound the (BLOCK_SIZE, N_train) distance buffer
+BLOCK_SIZE = 512
 
-class KNN(object):
-    """
-        kNN classifier object.
-    """
-
-    ##Added by me 
-
-    def find_k_nearest_neighbors(self,k, distances):
-        """ Find the indices of the k smallest distances from a list of distances.
-
-        Inputs:
-            k: integer
-            distances: shape (N,) 
-        Outputs:
-            indices of the k nearest neighbors: shape (k,)
-        """
-        indices = np.argsort(distances)
-        return indices[:k]
-
-    def euclidean_dist(self,example, training_examples):
-        """Compute the Euclidean distance between a single example
-        vector and all training_examples.
-
-        Inputs:
-            example: shape (D,)
-            training_examples: shape (NxD) 
-        Outputs:
-            euclidean distances: shape (N,)
-        """
-        return np.sqrt(np.sum(np.square(example - training_examples),axis = 1))
-
-    def l3_norm(self,example, training_examples,epsilon=1e-10):
-        """Compute the L3-Norm between a single example
-        vector and all training_examples.
-
-        Inputs:
-            example: shape (D,)
-            training_examples: shape (NxD) 
-        Outputs:
-            l3 norm: shape (N,)
-        """
-        return (np.sum((np.abs(example-training_examples))**3,axis=1))**(1/3)
-
-    def manhattan_distance(self,example,training_examples):
-        """Compute the Manhattan distance (L1-Norm) between a single example
-        vector and all training_examples.
-
-        Inputs:
-            example: shape (D,)
-            training_examples: shape (NxD) 
-        Outputs:
-            manhattan distances: shape (N,)
-        """
-        return (np.sum(np.abs(example - training_examples),axis = 1))
-
-    def cosine_distances_to_all(self,example,training_examples):
-        """Compute the Cosine Distance between a single example
-        vector and all training_examples.
 
-        Inputs:
-            example: shape (D,)
-            training_examples: shape (NxD) 
-        Outputs:
-            cosine distances: shape (N,)
-        """
-        # Normalize each training vector
-        normalized_training = training_examples / np.linalg.norm(training_examples, axis=1, keepdims=True)
-
-        # Normalize the example vector
-        normalized_example = example / np.linalg.norm(example)
-
-        # Compute cosine similarity for all examples
-        cosine_similarities = normalized_training @ normalized_example
-
-        # Convert similarities into distances
-        return 1 - cosine_similarities
-    
+@njit(parallel=True, cache=True, fastmath=True)
+def knn_vote(D2, Y_train, k, C, out):
+    """Write in out the most frequent label among the k nearest neighbors of
+    each example, ties going to the smallest label.
 
-    def predict_label_aux(self,neighbor_labels):
-        """Return the most frequent label in the neighbors'.
+    Inputs:
+        D2: distances to the training examples, shape (N,N_train)
+        Y_train: training labels in [0, C), shape (N_train,)
+        k: integer
+        C: number of classes
+        out: predicted labels, shape (N,)
+    """
+    N = D2.shape[0]
+    for i in prange(N):
+        idx = np.argpartition(D2[i], k - 1)[:k]
+        counts = np.zeros(C, np.int64)
+        for j in idx:
+            counts[Y_train[j]] += 1
+        out[i] = np.argmax(counts)
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def knn_mean(D2, Y_train, k, out):
+    """Write in out the mean target of the k nearest neighbors of each example.
+
+    Inputs:
+        D2: distances to the training examples, shape (N,N_train)
+        Y_train: training targets, shape (N_train,R)
+        k: integer
+        out: predicted targets, shape (N,R)
+    """
+    N = D2.shape[0]
+    R = Y_train.shape[1]
+    for i in prange(N):
+        idx = np.argpartition(D2[i], k - 1)[:k]
+        for r in range(R):
+            acc = 0.0
+            for j in idx:
+                acc += Y_train[j, r]
+            out[i, r] = acc / k
 
-        Inputs:
-            neighbor_labels: shape (N,) 
-        Outputs:
-            most frequent label
-        """
-        return np.argmax(np.bincount(neighbor_labels))
-
-    def kNN_one_example(self,unlabeled_example, training_features, training_labels, k, task):
-        """Returns the label of a single unlabelled example.
-
-        Inputs:
-            unlabeled_example: shape (D,) 
-            training_features: shape (NxD)
-            training_labels: shape (N,) 
-            k: integer
-        Outputs:
-            predicted label
-        """    
-        # Compute distances
-        distances = self.euclidean_dist(unlabeled_example,training_features)
-        
-        # Find neighbors
-        nn_indices = self.find_k_nearest_neighbors(k,distances)
-        
-        # Get neighbors' labels
-        neighbor_labels = training_labels[nn_indices]
-
-        # Pick the most common
-        if task == "classification":
-            return self.predict_label_aux(neighbor_labels)
-        else:
-            return np.mean(neighbor_labels,axis=0)
 
+class KNN(object):
+    """
+        kNN classifier object.
+    """
 
     ### Provided code
     def __init__(self, k=1, task_kind = "classification"):
@@ -140,6 +78,18 @@ class KNN(object):
         """
         self.training_data = training_data
         self.training_labels = training_labels
+
+        # Keep a contiguous single precision copy of the training data and its
+        # squared norms, which are reused by every distance computation
+        self.Xt = np.ascontiguousarray(training_data, dtype=np.float32)
+        self.sq = np.einsum('ij,ij->i', self.Xt, self.Xt)
+        if self.task_kind == "classification":
+            self.C = int(np.max(training_labels)) + 1
+            self.Yt = np.ascontiguousarray(training_labels, dtype=np.int64)
+        else:
+            # Regression targets are viewed as (N,R) for the averaging kernel
+            dtype = np.result_type(training_labels, np.float32)
+            self.Yt = np.ascontiguousarray(training_labels, dtype=dtype).reshape(len(training_labels), -1)
         return self.predict(training_data)
 
     def predict(self, test_data):
@@ -151,7 +101,32 @@ class KNN(object):
             Returns:
                 test_labels (np.array): labels of shape (N,)
         """
-        return np.apply_along_axis(self.kNN_one_example,1,test_data,self.training_data,self.training_labels,self.k,self.task_kind)
+        Q = np.ascontiguousarray(test_data, dtype=np.float32)
+        q_sq = np.einsum('ij,ij->i', Q, Q)
+        N = Q.shape[0]
+        k = min(self.k, self.Xt.shape[0])
+        if self.task_kind == "classification":
+            pred_labels = np.empty(N, dtype=np.int64)
+        else:
+            pred_labels = np.empty((N, self.Yt.shape[1]), dtype=self.Yt.dtype)
+
+        # Process the test examples by blocks of B rows of distances
+        B = BLOCK_SIZE
+        for i in range(0, N, B):
+            # Squared euclidean distances to all training examples with a single
+            # matrix product: ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x
+            # (the square root is not needed to rank the neighbors)
+            D2 = q_sq[i:i+B, None] + self.sq[None, :] - 2.0 * (Q[i:i+B] @ self.Xt.T)
+            np.maximum(D2, 0, out=D2)
+
+            if self.task_kind == "classification":
+                knn_vote(D2, self.Yt, k, self.C, pred_labels[i:i+B])
+            else:
+                knn_mean(D2, self.Yt, k, pred_labels[i:i+B])
+
+        if self.task_kind != "classification":
+            pred_labels = pred_labels.reshape((N,) + self.training_labels.shape[1:])
+        return pred_labels
 
     
 
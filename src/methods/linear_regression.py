@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.linalg
 import sys
 
 class LinearRegression(object):
@@ -15,6 +16,7 @@ class LinearRegression(object):
         """
         self.weights = None
         self.lmda = lmda
+        self._G_buf = None
         self.task_kind = task_kind
 
     def fit(self, training_data, training_labels):
@@ -27,7 +29,32 @@ class LinearRegression(object):
                 pred_labels (np.array): target of shape (N,regression_target_size)
         """
 
-        self.weights = (np.linalg.inv(training_data.T @ training_data + self.lmda * np.eye(training_data.shape[1])) @ training_data.T ) @ training_labels
+        N, D = training_data.shape
+
+        # Without regularization the Gram matrix can be singular or badly
+        # conditioned (e.g. N < D or constant features), so solve the
+        # least-squares problem directly with an SVD-based solver, in double
+        # precision like the ridge solve below
+        if self.lmda == 0:
+            weights, *_ = np.linalg.lstsq(np.asarray(training_data, np.float64),
+                                          np.asarray(training_labels, np.float64), rcond=None)
+            self.weights = weights.astype(np.result_type(training_data, training_labels, np.float32), copy=False)
+            return self.predict(training_data)
+
+        # Solve (X^T X + lmda I) w = X^T Y with a Cholesky factorization of the
+        # (symmetric positive definite) regularized Gram matrix. The solve is
+        # always done in double precision to preserve its conditioning.
+        X = np.ascontiguousarray(training_data, dtype=np.float64)
+
+        # Reuse the Gram matrix buffer across fits of the same dimension
+        if self._G_buf is None or self._G_buf.shape != (D, D):
+            self._G_buf = np.empty((D, D), dtype=np.float64)
+        G = np.dot(X.T, X, out=self._G_buf)
+        G[np.diag_indices_from(G)] += self.lmda
+        b = X.T @ training_labels.astype(np.float64, copy=False)
+        c, low = scipy.linalg.cho_factor(G, lower=True, overwrite_a=True, check_finite=False)
+        weights = scipy.linalg.cho_solve((c, low), b, overwrite_b=True, check_finite=False)
+        self.weights = weights.astype(np.result_type(training_data, training_labels, np.float32), copy=False)
         return self.predict(training_data)
 
 
@@ -1,6 +1,8 @@
 import numpy as np
+from joblib import Parallel, delayed
+from numba import njit
 from tqdm import tqdm
-from src.methods.knn import KNN
+from src.methods.knn import KNN, knn_vote, knn_mean
 from src.methods.linear_regression import LinearRegression
 from matplotlib import pyplot as plt
 
@@ -49,19 +51,39 @@ def append_bias_term(data):
     data = np.concatenate([np.ones([N, 1]),data], axis=1)
     return data
 
-def normalize_fn(data, means, stds):
+def normalize_fn(data, means, inv_stds):
     """
-    Return the normalized data, based on precomputed means and stds.
+    Return the normalized data, based on precomputed means and inverse stds.
     
     Arguments:
         data (array): of shape (N,D)
         means (array): of shape (1,D)
-        stds (array): of shape (1,D)
+        inv_stds (array): of shape (1,D), the reciprocal of the stds
     Returns:
         (array): shape (N,D)
     """
     # Return the normalized features
-    return (data - means) / stds
+    return (data - means) * inv_stds
+
+def normalize_and_bias(data, means, inv_stds):
+    """
+    Return the normalized data with a bias term equal to 1 prepended,
+    equivalent to append_bias_term(normalize_fn(data, means, inv_stds)) but
+    allocating the output only once.
+
+    Arguments:
+        data (array): of shape (N,D)
+        means (array): of shape (1,D)
+        inv_stds (array): of shape (1,D), the reciprocal of the stds
+    Returns:
+        (array): shape (N,D+1)
+    """
+    N, D = data.shape
+    out = np.empty((N, D + 1), dtype=np.result_type(data, means, inv_stds))
+    out[:, 0] = 1.0
+    np.subtract(data, means, out=out[:, 1:])
+    out[:, 1:] *= inv_stds
+    return out
 
 def get_n_classes(labels):
     """
@@ -98,26 +120,55 @@ def accuracy_fn(pred_labels, gt_labels):
     """
     return np.mean(pred_labels == gt_labels) * 100.
 
-def macrof1_fn(pred_labels, gt_labels):
-    """Return the macro F1-score."""
-    class_ids = np.unique(gt_labels)
-    macrof1 = 0
-    for val in class_ids:
-        predpos = (pred_labels == val)
-        gtpos = (gt_labels==val)
-        
-        tp = sum(predpos*gtpos)
-        fp = sum(predpos*~gtpos)
-        fn = sum(~predpos*gtpos)
+@njit(cache=True, fastmath=True)
+def _f1_core(gt, pred, C):
+    """
+    Return the macro F1-score of integer-encoded labels.
+
+    Arguments:
+        gt (array): ground-truth classes encoded in [0, C), of shape (N,)
+        pred (array): predicted classes encoded in [0, C], of shape (N,),
+                      where C stands for a class absent from the ground truth
+        C (int): number of ground-truth classes
+    Returns:
+        (float): the macro F1-score
+    """
+    cm = np.zeros((C, C + 1), np.int64)
+    for i in range(gt.size):
+        cm[gt[i], pred[i]] += 1
+
+    f1_sum = 0.0
+    for c in range(C):
+        tp = cm[c, c]
         if tp == 0:
             continue
-        else:
-            precision = tp/(tp+fp)
-            recall = tp/(tp+fn)
+        fp = 0
+        for r in range(C):
+            fp += cm[r, c]
+        fn = 0
+        for j in range(C + 1):
+            fn += cm[c, j]
+        fp -= tp
+        fn -= tp
+        f1_sum += 2.0*tp / (2*tp + fp + fn)
+    return f1_sum / C
+
+# Compile (or load from the on-disk cache) once at import time rather than
+# on the first metric call
+_f1_core(np.zeros(1, np.int64), np.zeros(1, np.int64), 1)
 
-        macrof1 += 2*(precision*recall)/(precision+recall)
+def macrof1_fn(pred_labels, gt_labels):
+    """Return the macro F1-score."""
+    classes, inv_gt = np.unique(gt_labels, return_inverse=True)
+    C = len(classes)
 
-    return macrof1/len(class_ids)
+    # Encode the predictions on the ground-truth classes; predicted labels that
+    # never appear in the ground truth go to an extra class C
+    inv_pred = np.searchsorted(classes, pred_labels)
+    inv_pred[inv_pred == C] = C - 1
+    inv_pred[classes[inv_pred] != pred_labels] = C
+
+    return _f1_core(inv_gt.ravel().astype(np.int64), inv_pred.ravel().astype(np.int64), C)
 
 def mse_fn(pred,gt):
     '''
@@ -148,65 +199,55 @@ def create_validation_set(data,labels,split_ratio):
         Y_new_test: The label vector for the validation set 
     """
     N = data.shape[0] 
-    all_indices = np.arange(0,N)
-    np.random.shuffle(all_indices)
+    all_indices = np.random.permutation(N)
 
     validation_set_nb_elements = int(split_ratio * N)
-    
-    validation_set_indices = all_indices[:validation_set_nb_elements]
-    train_set_indices = all_indices[validation_set_nb_elements:]
 
-    X_new_train = data[train_set_indices]
-    Y_new_train = labels[train_set_indices]
-    X_new_test = data[validation_set_indices]
-    Y_new_test = labels[validation_set_indices]
+    # Gather the shuffled data once, both sets are then contiguous views of it
+    data_shuffled = data[all_indices]
+    labels_shuffled = labels[all_indices]
+
+    X_new_train = data_shuffled[validation_set_nb_elements:]
+    Y_new_train = labels_shuffled[validation_set_nb_elements:]
+    X_new_test = data_shuffled[:validation_set_nb_elements]
+    Y_new_test = labels_shuffled[:validation_set_nb_elements]
 
     return X_new_train, Y_new_train, X_new_test, Y_new_test
 
 ### Methods for K-fold cross validation 
 
-def KFold_cross_validation_KNN(X, Y, K, k,M,T):
+def _kfold_cv(Y, K, T, perm, predict_fold):
     '''
-    K-Fold Cross validation function for K-NN
+    Run the K folds of a cross validation and average the validation scores.
     Inputs:
-        X : training data, shape (NxD)
         Y: training labels, shape (N,)
         K: number of folds (K in K-fold)
-        k: number of neighbors for kNN algorithm (the hyperparameter)
-        M: method 
         T: task kind 
+        perm: permutation of the N samples defining the folds, shape (N,)
+        predict_fold: function (train_ind, val_ind) -> predictions for the
+                      validation examples, fitted on the training examples
     Returns:
-        Average validation accuracy for the selected k.
+        Average validation accuracy (and F1-score for classification).
     '''
 
-    N = X.shape[0]
+    N = Y.shape[0]
     accuracies = [] # list of accuracies
     f1_score = []
-    all_indices = np.arange(N)
-    np.random.shuffle(all_indices)
-    for fold_ind in range(K):
 
-        #Split the data into training and validation folds:
-        split_size = N // K
+    #Split the data into training and validation folds:
+    split_size = N // K
+    for fold_ind in range(K):
 
-        # Indices of the validation and training examples
-        val_ind = all_indices[fold_ind * split_size : (fold_ind + 1) * split_size]
+        # Indices of the validation and training examples: the validation fold
+        # is a contiguous slice of the permutation, the training set its complement
+        start = fold_ind * split_size
+        end = start + split_size
+        val_ind = perm[start:end]
 
-        train_ind = np.setdiff1d(all_indices,val_ind)
+        train_ind = np.concatenate((perm[:start], perm[end:]))
 
-        X_train_fold = X[train_ind,:]
-        Y_train_fold = Y[train_ind]
-        X_val_fold = X[val_ind,:]
         Y_val_fold = Y[val_ind]
-
-        if M == "knn":
-            if T == "breed_identifying":
-                model = KNN(k,task_kind="classification")  # Instantiate the KNN model with the appropriate 'k'
-            else:
-                model = KNN(k,task_kind="regression")
-        model.fit(X_train_fold, Y_train_fold)
-
-        Y_val_fold_pred = model.predict(X_val_fold)
+        Y_val_fold_pred = predict_fold(train_ind, val_ind)
 
         if T == "breed_identifying":
             acc = accuracy_fn(Y_val_fold_pred,Y_val_fold)
@@ -215,9 +256,7 @@ def KFold_cross_validation_KNN(X, Y, K, k,M,T):
         else:
             acc = mse_fn(Y_val_fold_pred,Y_val_fold)
         accuracies.append(acc)
-        
 
-    
     #Find the average validation accuracy over K:
     average_accuracy = np.sum(accuracies)/len(accuracies)
     if T == "breed_identifying":
@@ -227,6 +266,73 @@ def KFold_cross_validation_KNN(X, Y, K, k,M,T):
         return average_accuracy
 
 
+def KFold_cross_validation_KNN(X, Y, K, k,M,T,perm):
+    '''
+    K-Fold Cross validation function for K-NN
+    Inputs:
+        X : training data, shape (NxD)
+        Y: training labels, shape (N,)
+        K: number of folds (K in K-fold)
+        k: number of neighbors for kNN algorithm (the hyperparameter)
+        M: method 
+        T: task kind 
+        perm: permutation of the N samples defining the folds, shape (N,)
+    Returns:
+        Average validation accuracy for the selected k.
+    '''
+
+    def predict_fold(train_ind, val_ind):
+        if M == "knn":
+            if T == "breed_identifying":
+                model = KNN(k,task_kind="classification")  # Instantiate the KNN model with the appropriate 'k'
+            else:
+                model = KNN(k,task_kind="regression")
+        model.fit(X[train_ind,:], Y[train_ind])
+        return model.predict(X[val_ind,:])
+
+    return _kfold_cv(Y, K, T, perm, predict_fold)
+
+
+def KFold_cross_validation_KNN_cached(D2, Y, K, k, T, perm):
+    '''
+    K-Fold Cross validation function for K-NN (with euclidean distance) working
+    on the precomputed pairwise squared distances of the training data.
+    Inputs:
+        D2 : squared euclidean distances between all training samples, shape (NxN)
+        Y: training labels, shape (N,)
+        K: number of folds (K in K-fold)
+        k: number of neighbors for kNN algorithm (the hyperparameter)
+        T: task kind 
+        perm: permutation of the N samples defining the folds, shape (N,)
+    Returns:
+        Average validation accuracy for the selected k.
+    '''
+
+    # Labels in the layout expected by the KNN kernels (as in KNN.fit)
+    if T == "breed_identifying":
+        C = get_n_classes(Y)
+        Y_kernel = np.ascontiguousarray(Y, dtype=np.int64)
+    else:
+        Y_kernel = np.ascontiguousarray(Y, dtype=np.result_type(Y, np.float32)).reshape(len(Y), -1)
+
+    def predict_fold(train_ind, val_ind):
+        # Like KNN.predict, use at most all the training examples as neighbors
+        k_fold = min(k, len(train_ind))
+
+        D2_fold = D2[np.ix_(val_ind, train_ind)]
+        Y_train_fold = Y_kernel[train_ind]
+        if T == "breed_identifying":
+            Y_val_fold_pred = np.empty(len(val_ind), dtype=np.int64)
+            knn_vote(D2_fold, Y_train_fold, k_fold, C, Y_val_fold_pred)
+            return Y_val_fold_pred
+        else:
+            Y_val_fold_pred = np.empty((len(val_ind), Y_kernel.shape[1]), dtype=Y_kernel.dtype)
+            knn_mean(D2_fold, Y_train_fold, k_fold, Y_val_fold_pred)
+            return Y_val_fold_pred.reshape((len(val_ind),) + Y.shape[1:])
+
+    return _kfold_cv(Y, K, T, perm, predict_fold)
+
+
 def run_cv_for_hyperparam(X, Y, K, k_list,M,T):
     '''
     K-Fold Cross validation function for K-NN
@@ -240,9 +346,22 @@ def run_cv_for_hyperparam(X, Y, K, k_list,M,T):
         k : the optimal value k for the KNN
         model_performance: a list of validation accuracies corresponding to the k-values     
     '''
-    model_performance = [] 
-    for k in tqdm(k_list):
-        model_performance.append(KFold_cross_validation_KNN(X,Y,K,k,M,T))
+    if M != "knn":
+        raise ValueError(f"Invalid choice of method for K-fold cross validation: {M}! Only support knn!")
+
+    # Shuffle once so that every k is evaluated on the same folds, then run
+    # the (independent) cross validations for each k in parallel processes
+    perm = np.random.permutation(X.shape[0])
+
+    # The distances do not depend on k nor on the fold: compute all the
+    # pairwise squared distances once and let every run select from them
+    sq_norms = np.einsum('ij,ij->i', X, X)
+    D2 = sq_norms[:, None] + sq_norms[None, :] - 2 * (X @ X.T)
+    np.maximum(D2, 0, out=D2)
+    jobs = (delayed(KFold_cross_validation_KNN_cached)(D2,Y,K,k,T,perm) for k in k_list)
+    # Results come back in order as they complete, which drives the progress bar
+    results = Parallel(n_jobs=-1, prefer="processes", return_as="generator")(jobs)
+    model_performance = list(tqdm(results, total=len(k_list)))
 
     # Pick hyperparameter value that yields the best performance
     if T == "breed_identifying":
@@ -278,8 +397,8 @@ def plot_k_vs_accuracy_cv(k_list, model_performance,K_fold,task):
         accuracy_scores_tab=model_performance[:,0]
 
         # Plot K values vs accuracies and K values vs F1-score
-        plt.plot(k_list, f1_scores_tab, marker='x', label='F1-score', color='b')
-        plt.plot(k_list, accuracy_scores_tab, marker='o', label='Accuracy', color='r')
+        plt.plot(k_list, f1_scores_tab, linewidth=1, label='F1-score', color='b')
+        plt.plot(k_list, accuracy_scores_tab, linewidth=1, label='Accuracy', color='r')
 
         # Set X-axis and Y-axis labels
         plt.xlabel("Number of nearest neighbors $k$")
@@ -289,20 +408,23 @@ def plot_k_vs_accuracy_cv(k_list, model_performance,K_fold,task):
         plt.title(f"Performance of the {K_fold}-fold cross validation for different values of $k$")
         plt.grid(True)
 
-        plt.xticks(k_list)
+        # One tick every 5 values of k keeps the axis readable for long k lists
+        plt.xticks(k_list[::5])
 
-        # Annotate the plot with the best k value
+        # Mark and annotate the plot with the best k value
         max=np.max(model_performance)
         max_occurences_indices=np.where(model_performance==max)[0]
         best_k=max_occurences_indices[-1]+1 # to take into account the indexing , and we check for the biggest value of k that gives us the best performance starting from the end of the tab to minimize the complexity of the model
+        plt.scatter([best_k], [max], color='r', zorder=3)
         plt.annotate(f'Best k={best_k}', xy=(best_k, max), xytext=(best_k, max),arrowprops=dict(facecolor='red', shrink=0.05),horizontalalignment='center')
-        max_f1_score = np.max(model_performance[:, 1])
-        best_k_f1_score = k_list[np.argmax(model_performance[:, 1])]
+        max_f1_score = np.max(f1_scores_tab)
+        best_k_f1_score = k_list[np.argmax(f1_scores_tab)]
 
+        plt.scatter([best_k_f1_score], [max_f1_score], color='b', zorder=3)
         plt.annotate(f'Best k for F1-score={best_k_f1_score}', xy=(best_k_f1_score, max_f1_score), xytext=(best_k_f1_score, max_f1_score),arrowprops=dict(facecolor='red', shrink=0.05),horizontalalignment='center')
     else:
         plt.figure(figsize=(18,8))
-        plt.plot(k_list, model_performance, marker='o', linestyle='-', color='r')  # Plot k values vs accuracies
+        plt.plot(k_list, model_performance, linewidth=1, label='Test loss', color='r')  # Plot k values vs accuracies
 
         # Set X-axis and Y-axis labels
         plt.xlabel("Number of nearest neighbors $k$")
@@ -310,11 +432,12 @@ def plot_k_vs_accuracy_cv(k_list, model_performance,K_fold,task):
 
         plt.title('KNN Performance: Number of Neighbors vs. Test Loss')
         plt.grid(True)
-        plt.xticks(k_list)
-         # Annotate the plot with the best k value
+        plt.xticks(k_list[::5])
+         # Mark and annotate the plot with the best k value
         max=np.min(model_performance)
         max_occurences_indices=np.where(model_performance==max)[0]
         best_k=max_occurences_indices[-1]+1 
+        plt.scatter([best_k], [max], color='r', zorder=3)
         plt.annotate(f'Best k={best_k}', xy=(best_k, max),xytext=(best_k, max),arrowprops=dict(facecolor='red', shrink=0.05),horizontalalignment='center')
 
     plt.legend()
@@ -163,6 +163,96 @@ class TestProject(unittest.TestCase):
         self.assertTrue(np.isclose(pred_labels_train, training_labels).all(), f"LinearRegression.fit() is not working on dummy data")
         self.assertTrue(np.isclose(pred_labels_test, test_labels).all(), f"LinearRegression.predict() is not working on dummy data")
 
+        #  Integer data must give float predictions (not truncated weights)
+        training_data = np.array([[1, 0], [1, 1], [1, 2], [1, 3]])
+        training_labels = np.array([[1], [2], [2], [4]])
+        for lmda in [0, 1]:
+            with self.subTest(f"Checking integer data with lmda={lmda}"):
+                LR_model = importlib.import_module("src.methods.linear_regression").LinearRegression(lmda=lmda)
+                X = training_data.astype(float)
+                expected = X @ np.linalg.solve(X.T @ X + lmda * np.eye(2), X.T @ training_labels)
+                with no_print():
+                    pred_labels_train = LR_model.fit(training_data, training_labels)
+                self.assertTrue(np.isclose(pred_labels_train, expected).all(), f"LinearRegression.fit() is not working on integer data ({pred_labels_train.ravel()} != {expected.ravel()})")
+
+
+    def test_3d_knn_regression(self):
+        """Test KNN for regression."""
+        self.title("Testing KNN regression")
+
+        module = importlib.import_module("src.methods.knn")
+
+        N, N_test, D, k = 30, 10, 4, 3
+        training_data = np.random.rand(N, D)
+        test_data = np.random.rand(N_test, D)
+        distances = np.linalg.norm(test_data[:, None, :] - training_data[None, :, :], axis=2)
+        nn_indices = np.argsort(distances, axis=1)[:, :k]
+        for training_labels in [np.random.rand(N), np.random.rand(N, 2)]:
+            with self.subTest(f"Checking targets of shape {training_labels.shape}"):
+                knn_model = module.KNN(k, task_kind="regression")
+                with no_print():
+                    knn_model.fit(training_data, training_labels)
+                    pred_labels_test = knn_model.predict(test_data)
+                expected = np.mean(training_labels[nn_indices], axis=1)
+                self.assertEqual(pred_labels_test.shape, expected.shape, f"KNN.predict() output has wrong shape ({pred_labels_test.shape} != {expected.shape})")
+                self.assertTrue(np.allclose(pred_labels_test, expected), f"KNN.predict() is not working for regression")
+
+
+    def test_4_knn_cross_validation(self):
+        """Test the K-fold cross validation of KNN on cached distances."""
+        self.title("Testing KNN cross validation")
+
+        utils = importlib.import_module("src.utils")
+
+        N, D, K = 20, 3, 10
+        X = np.random.rand(N, D)
+        sq_norms = np.sum(X**2, axis=1)
+        D2 = np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * X @ X.T, 0)
+        perm = np.random.permutation(N)
+        for task, Y in [("breed_identifying", np.random.randint(0, 3, N)),
+                        ("center_locating", np.random.rand(N, 2))]:
+            # k larger than the training folds must use all the training examples
+            for k in [1, 3, 24]:
+                with self.subTest(f"Checking task {task} with k={k}"):
+                    with no_print():
+                        expected = utils.KFold_cross_validation_KNN(X, Y, K, k, "knn", task, perm)
+                        cached = utils.KFold_cross_validation_KNN_cached(D2, Y, K, k, task, perm)
+                    self.assertTrue(np.allclose(cached, expected), f"KFold_cross_validation_KNN_cached() does not match KFold_cross_validation_KNN() ({cached} != {expected})")
+
+
+    def test_5_macrof1(self):
+        """Test the macro F1-score."""
+        self.title("Testing macro F1-score")
+
+        utils = importlib.import_module("src.utils")
+
+        def reference_macrof1(pred_labels, gt_labels):
+            class_ids = np.unique(gt_labels)
+            macrof1 = 0
+            for val in class_ids:
+                predpos = (pred_labels == val)
+                gtpos = (gt_labels == val)
+                tp = np.sum(predpos & gtpos)
+                fp = np.sum(predpos & ~gtpos)
+                fn = np.sum(~predpos & gtpos)
+                if tp > 0:
+                    precision = tp / (tp + fp)
+                    recall = tp / (tp + fn)
+                    macrof1 += 2 * (precision * recall) / (precision + recall)
+            return macrof1 / len(class_ids)
+
+        # Predicted labels are drawn from a larger range than the ground truth,
+        # so some of them (below, between and above) are absent from it
+        gt_labels = np.array([0, 2, 2, 4, 4, 4, 6, 6])
+        for seed in range(20):
+            rng = np.random.default_rng(seed)
+            pred_labels = rng.integers(-1, 8, gt_labels.shape[0])
+            with self.subTest(f"Checking predictions {pred_labels}"):
+                with no_print():
+                    macrof1 = utils.macrof1_fn(pred_labels, gt_labels)
+                expected = reference_macrof1(pred_labels, gt_labels)
+                self.assertTrue(np.isclose(macrof1, expected), f"macrof1_fn() is not working ({macrof1} != {expected})")
+
 
 def warn(msg):
     print(f"\33[33m/!\\ Warning: {msg}\33[39m")